@@ -1,14 +1,42 @@
 # manifest
 # - generate disk manifests and run simple operations on them
 
+import hashlib
+import struct
+import threading
 from collections import namedtuple
-entry_tuple = namedtuple('entry', ['hash', 'path', 'size'], defaults=[None])
+entry_tuple = namedtuple('entry', ['hash', 'path', 'size', 'mtime_ns'], defaults=[None, None])
 start_time = 0.0
 
 
+def pick_sha1():
+    """Returns the SHA-1 constructor to hash with, and a description of it"""
+    # When Python is linked against OpenSSL (the normal case), hashlib.sha1 is OpenSSL's
+    # implementation, which does its own cpuid check and uses the SHA extensions (SHA-NI on
+    # x86, SHA1 instructions on ARMv8) when the CPU has them. Otherwise it's Python's own
+    # portable C version, which has no hardware path, so say so.
+    if hashlib.sha1.__name__.startswith('openssl_'):
+        return hashlib.sha1, "OpenSSL (uses CPU SHA instructions when present)"
+    return hashlib.sha1, "builtin (no OpenSSL, so no CPU SHA instructions)"
+
+
+sha1_new, sha1_description = pick_sha1()
+
+# Read size for hashing. Big reads mean fewer syscalls and fewer trips through the
+# interpreter per MB; 1 MB is well past the point where per-read overhead stops mattering.
+HASH_BLOCKSIZE = 1 << 20
+
+# How many blocks get_hash asks the OS to fetch ahead of the one it's hashing
+HASH_READAHEAD = 4
+
+# Per-thread read buffers for get_hash
+hash_buffers = threading.local()
+
+
 def main():
     import time
     global start_time
+    global HASH_BLOCKSIZE
     start_time = time.time()
 
     import argparse
@@ -20,9 +48,25 @@ def main():
     parser.add_argument('--show-all', action='store_true', help='show all files, not just dups')
     parser.add_argument('--scan', action='store_true', help='compute hashes for the given paths')
     parser.add_argument('--report', help='path to write report to')
+    parser.add_argument('--jobs', '-j', type=int, default=8, help='number of hashing threads')
+    parser.add_argument(
+        '--dedup-fast', action='store_true',
+        help='only hash files that share their size with another file')
+    parser.add_argument(
+        '--sort-by-inode', action='store_true',
+        help='list all files first and hash them in inode order (helps on spinning disks)')
+    parser.add_argument(
+        '--blocksize', type=int, default=HASH_BLOCKSIZE, help='read size when hashing files')
     parser.add_argument('--verbose', '-v', action='store_true', help='verbose output')
     args = parser.parse_args()
     print(f"paths: {args.paths}")
+    if args.verbose:
+        print(f"SHA-1: {sha1_description}")
+    HASH_BLOCKSIZE = max(1, args.blocksize)
+
+    import signal
+    if hasattr(signal, 'SIGWINCH'):
+        signal.signal(signal.SIGWINCH, update_term_columns)
 
     scanner = Scanner(args=args)
 
@@ -40,7 +84,9 @@ class Scanner(object):
         self.args = args
 
     def scan_paths(self, paths=None, manifest_path=None):
-        scan_paths(paths, manifest_path, self.args.verbose)
+        scan_paths(
+            paths, manifest_path, self.args.verbose, self.args.jobs, self.args.sort_by_inode,
+            self.args.dedup_fast)
 
     def find_dups(self, manifest_path=None, report_path=None, max_size=0, show_all=False):
         find_dups(manifest_path, report_path, max_size, show_all)
@@ -52,96 +98,437 @@ class Manifest(object):
 
 
 class Status(object):
+    """Progress counters, shown on the console by a background thread
+
+    Hot loops just assign to the fields. While started, the thread formats and shows them
+    every 0.1 seconds, so the loops never pay for clock reads, formatting or terminal
+    writes. Bytes read are counted per hashing thread (see read_counter), since several
+    threads adding to one field would lose updates. Anything else printed to the console
+    while the thread runs should go through print(), so it doesn't collide with the
+    status line.
+    """
     def __init__(self):
-        pass
-
-
-def scan_paths(paths, manifest_path, verbose):
+        self.num_files = 0
+        self.hashed_files = 0
+        self.sized_files = 0
+        self.path = ""
+        self.read_counters = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stop_event = None
+        self.thread = None
+
+    def read_counter(self):
+        """Returns the calling thread's bytes-read counter, a one-item list it adds to"""
+        counter = getattr(self.local, 'read_counter', None)
+        if counter is None:
+            counter = self.local.read_counter = [0]
+            with self.lock:
+                self.read_counters.append(counter)
+        return counter
+
+    def print(self, *args, file=None):
+        """Prints a line, erasing the status line first if it's going to the console"""
+        import sys
+        with self.lock:
+            if file is None or file is sys.stdout:
+                console_status("")
+            print(*args, file=file)
+
+    def start(self):
+        import threading
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            console_status("")
+
+    def run(self):
+        import signal
+        ticks = 0
+        while not self.stop_event.wait(0.1):
+            ticks += 1
+            if not hasattr(signal, 'SIGWINCH') and ticks % 10 == 0:
+                update_term_columns()
+            self.show()
+
+    def show(self):
+        import time
+        elapsed_time = time.time() - start_time
+        with self.lock:
+            read_bytes = sum(counter[0] for counter in self.read_counters)
+            read_MB = int(0.5 + read_bytes / 1000000)
+            msg = (
+                f"T+{elapsed_time:.1f} Hashed={self.hashed_files} ({read_MB}MB) "
+                f"Sized={self.sized_files} Total={self.num_files} {self.path}")
+            console_status(msg)
+
+
+status = Status()
+
+
+def scan_paths(
+        paths, manifest_path, verbose, jobs=8, sort_by_inode=False, dedup_fast=False):
     import time
     start_time = time.time()
+    status.start()
 
     # If we have an existing manifest, read it and set up a dict so we can mine it for
-    # content hashes. This will grow to be a full merge of new data into existing data
-    manifest = read_manifest(manifest_path)
+    # content hashes. This will grow to be a full merge of new data into existing data.
+    # If it won't read, take the status line down before giving up.
+    try:
+        manifest = read_manifest(manifest_path)
+    except BaseException:
+        status.stop()
+        raise
     path_hashes = dict()
     if manifest is not None:
         for entry in manifest:
             # path_hashes[entry.path] = entry.hash
             path_hashes[entry.path] = entry
-    print(f"Got {len(path_hashes)} existing hashes from manifest")
-
-    # Build up a full manifest
-    manifest = []
-    for path in paths:
-        walk(path, path_hashes, manifest, verbose)
+    manifest = None  # from here on we only need the dict
+    status.print(f"Got {len(path_hashes)} existing hashes from manifest")
+
+    # Build up a full manifest. One thread walks the paths and queues up file paths, a pool
+    # of worker threads gets sizes and hashes, and we collect the finished entries here, so
+    # only this thread ever touches the manifest writer. hashlib releases the GIL while it
+    # hashes, so the workers overlap disk reads with each other and with hashing. Entries
+    # are written out as they arrive, so memory doesn't grow with the size of the tree.
+    # Workers finish out of order, so walk numbers the files, and we hold early finishers
+    # back until everything before them is written; the manifest comes out in walk order,
+    # the same from run to run. walk can't get more than in_flight files ahead of the
+    # oldest one not yet written, which bounds how many we ever hold back.
+    if manifest_path is not None:
+        status.print(f"Writing version {ManifestWriter.version} manifest to {manifest_path}")
+    writer = ManifestWriter(manifest_path)
+    import queue
+    import threading
+    jobs = max(1, jobs)
+    work = queue.Queue(maxsize=1024)
+    results = queue.Queue(maxsize=1024)
+    cancel = threading.Event()
+    in_flight = threading.Semaphore(4096)
+    threads = [threading.Thread(
+        target=walk,
+        args=(
+            paths, work, results, jobs, in_flight, cancel, path_hashes, sort_by_inode,
+            dedup_fast),
+        daemon=True)]
+    for _ in range(jobs):
+        threads.append(threading.Thread(
+            target=hash_worker, args=(work, results, cancel, path_hashes, verbose),
+            daemon=True))
+    for thread in threads:
+        thread.start()
+
+    # Every worker posts a stop marker when it's done, even if it fails, so we always get
+    # here. If walk or a worker fails it posts its exception; we tell everyone to wind
+    # down, then raise it once they have. Whatever goes wrong, a partial manifest must not
+    # replace the old one, so the writer's temporary file is thrown away instead.
+    failure = None
+    sized_files = 0
+    hashed_files = 0
+    running = jobs
+    held_back = dict()
+    next_seq = 0
+    try:
+        while running > 0:
+            result = results.get()
+            if result is None:
+                running -= 1
+                continue
+            if isinstance(result, BaseException):
+                failure = failure or result
+                cancel.set()
+                continue
+            if failure is not None:
+                continue
+            seq, entry, hashed = result
+            held_back[seq] = (entry, hashed)
+            while next_seq in held_back:
+                entry, hashed = held_back.pop(next_seq)
+                next_seq += 1
+                in_flight.release()
+                writer.append(entry)
+                if entry.size is not None:
+                    sized_files += 1
+                if hashed:
+                    hashed_files += 1
+            status.num_files = writer.num_entries
+            status.hashed_files = hashed_files
+            status.sized_files = sized_files
+            status.path = entry.path
+        if failure is not None:
+            raise failure
+        writer.finalize()
+    except BaseException:
+        cancel.set()
+        writer.discard()
+        status.stop()
+        raise
     end_time = time.time()
     delta_secs = end_time - start_time
 
-    # Save manifest
-    write_manifest(manifest, manifest_path)
-    console_status("")
+    status.stop()
     print(f"Elapsed time: {delta_secs:.3f} seconds")
 
 
-def walk(base_path, path_hashes, manifest, verbose):
+def walk(
+        paths, work, results, jobs, in_flight, cancel, path_hashes, sort_by_inode=False,
+        dedup_fast=False):
+    """Queues every file under paths, followed by a stop marker for each worker
+
+    Each file is queued as (seq, DirEntry, needs_hash), where seq numbers the files in
+    walk order, and needs_hash is False for files to record as not hashed. Takes one
+    in_flight count per file, and stops early if cancel gets set. If something goes wrong,
+    the exception is posted to results, and the workers are still told to stop.
+    """
+    import operator
+    try:
+        dir_entries = (
+            dir_entry for base_path in paths for dir_entry in scan_files(base_path))
+        if sort_by_inode:
+            # On a spinning disk, hashing files in directory order has the head seeking
+            # all over. Inode order roughly follows where the file system put things, so
+            # list the whole tree first and then hash in that order.
+            dir_entries = sorted(dir_entries, key=operator.methodcaller('inode'))
+        if dedup_fast:
+            items = dedup_candidates(list(dir_entries), path_hashes, jobs)
+        else:
+            items = ((dir_entry, True) for dir_entry in dir_entries)
+        for seq, (dir_entry, needs_hash) in enumerate(items):
+            while not in_flight.acquire(timeout=0.1):
+                if cancel.is_set():
+                    return
+            if cancel.is_set():
+                break
+            work.put((seq, dir_entry, needs_hash))
+    except BaseException as e:
+        results.put(e)
+    finally:
+        for _ in range(jobs):
+            work.put(None)
+
+
+def dedup_candidates(dir_entries, path_hashes, jobs):
+    """Pairs each DirEntry with whether it needs a hash
+
+    A file whose size no other file has can't be a duplicate, so when all we want is to
+    find duplicates, there's no point reading it. This is usually most of the files.
+    Files that do share a size often still differ in their first or last few KB, which
+    is much cheaper to check than reading them whole, so only files that also match
+    there get a full hash.
+
+    On a rescan, files that haven't changed since path_hashes was made aren't read at
+    all: hash_worker reuses their hash, or if they weren't hashed and nothing new shares
+    their size, they still can't have a duplicate.
+    """
+    from collections import defaultdict
+    from concurrent.futures import ThreadPoolExecutor
+    sizes = []
+    old_entries = []
+    size_groups = defaultdict(list)
+    for i, dir_entry in enumerate(dir_entries):
+        try:
+            st = dir_entry.stat(follow_symlinks=False)
+            size = st.st_size
+            old_entry = path_hashes.get(dir_entry.path)
+            if not unchanged(old_entry, size, st.st_mtime_ns):
+                old_entry = None
+        except OSError:
+            size = None
+            old_entry = None
+        sizes.append(size)
+        old_entries.append(old_entry)
+        size_groups[size].append(i)
+
+    needs_hash = [True] * len(dir_entries)
+    to_fingerprint = []
+    for size, group in size_groups.items():
+        if size is None:
+            continue
+        if len(group) == 1:
+            needs_hash[group[0]] = False
+            continue
+        unhashed = [i for i in group if old_entries[i] is None or old_entries[i].hash is None]
+        if all(old_entries[i] is not None for i in group):
+            # nothing new at this size, so what wasn't hashed before still needn't be
+            for i in unhashed:
+                needs_hash[i] = False
+        elif len(unhashed) == len(group) and size > 2 * QUICK_FINGERPRINT_BYTES:
+            # smaller files are read whole by the fingerprint anyway, so just hash them.
+            # We don't have fingerprints for files we already have a hash for, so if
+            # the group has any of those, the rest get hashed too.
+            to_fingerprint.extend(group)
+
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        fingerprints = pool.map(
+            quick_fingerprint,
+            [dir_entries[i].path for i in to_fingerprint], [sizes[i] for i in to_fingerprint])
+        fingerprint_groups = defaultdict(list)
+        for i, fingerprint in zip(to_fingerprint, fingerprints):
+            if fingerprint is not None:
+                fingerprint_groups[(sizes[i], fingerprint)].append(i)
+    for (size, fingerprint), group in fingerprint_groups.items():
+        if len(group) == 1:
+            needs_hash[group[0]] = False
+    return list(zip(dir_entries, needs_hash))
+
+
+def quick_fingerprint(file_path, size):
+    """Returns a digest of the first and last few KB of a file, or None if we can't read it"""
+    status.path = file_path
+    try:
+        with open(file_path, 'rb') as f:
+            head = f.read(QUICK_FINGERPRINT_BYTES)
+            f.seek(max(0, size - QUICK_FINGERPRINT_BYTES))
+            tail = f.read(QUICK_FINGERPRINT_BYTES)
+    except OSError:
+        return None
+    return hashlib.blake2b(head + tail, digest_size=16).digest()
+
+
+def scan_files(base_path):
+    """Yields a DirEntry for every regular file under base_path"""
+    # We use os.scandir directly instead of os.walk so that we keep the DirEntry objects,
+    # and get sizes from DirEntry.stat() instead of a separate os.path.getsize. On Windows
+    # that stat comes for free with the directory read. Symlinks aren't followed, and like
+    # os.walk, directories we can't read are skipped.
     import os
-    sized_files = 0
-    hashed_files = 0
-    for root, _, files in os.walk(base_path):
-        for f in files:
+    pending = [base_path]
+    while pending:
+        dir_path = pending.pop()
+        subdirs = []
+        try:
+            with os.scandir(dir_path) as it:
+                for dir_entry in it:
+                    try:
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            subdirs.append(dir_entry.path)
+                        elif dir_entry.is_file(follow_symlinks=False):
+                            yield dir_entry
+                    except OSError:
+                        pass
+        except OSError:
+            continue
+        # visit subdirectories in listed order, top-down like os.walk
+        pending.extend(reversed(subdirs))
+
+
+def hash_worker(work, results, cancel, path_hashes, verbose):
+    """Turns queued DirEntry objects into manifest entries until it sees a stop marker
+
+    Always posts a stop marker of its own when it finishes. If something goes wrong, the
+    exception is posted just before it. Once cancel is set, queued items are dropped.
+    """
+    try:
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            if cancel.is_set():
+                continue
+            seq, dir_entry, needs_hash = item
+            item_path = dir_entry.path
 
             # Get existing entry (if there is one). We will discard the old entry
             # if we think it's no longer valid (e.g. file metadata changed)
-            item_path = os.path.join(root, f)
-            old_entry = None
-            if item_path in path_hashes:
-                old_entry = path_hashes[item_path]
+            old_entry = path_hashes.get(item_path)
 
-            # get file metadata (for now, just size)
+            # get file metadata (size and modification time)
             try:
-                item_size = os.path.getsize(item_path)
-                if old_entry is not None and item_size != old_entry.size:
+                st = dir_entry.stat(follow_symlinks=False)
+                item_size = st.st_size
+                item_mtime_ns = st.st_mtime_ns
+                if not unchanged(old_entry, item_size, item_mtime_ns):
                     old_entry = None
-                sized_files += 1
             except Exception:
                 if verbose:
-                    console_status("")
-                    print(f"Failed to get size: {item_path}")
+                    status.print(f"Failed to get size: {item_path}")
                 item_size = None
+                item_mtime_ns = None
                 old_entry = None
 
-            # update file hash if we don't have an existing one
+            # update file hash if we don't have an existing one. Files walk says can't
+            # have a duplicate are recorded as not hashed, with no hash at all.
             item_hash = None
-            if old_entry is not None:
+            hashed = False
+            if old_entry is not None and old_entry.hash is not None:
                 item_hash = old_entry.hash
-            if item_hash is None:
+            elif needs_hash:
                 if verbose:
-                    console_status("")
-                    print(f"Getting hash for: {item_path}")
+                    status.print(f"Getting hash for: {item_path}")
                 item_hash = get_hash(item_path)
-                hashed_files += 1
+                hashed = True
+
+            entry = entry_tuple(
+                hash=item_hash, path=item_path, size=item_size, mtime_ns=item_mtime_ns)
+            results.put((seq, entry, hashed))
+    except BaseException as e:
+        results.put(e)
+    finally:
+        results.put(None)
+
+
+def unchanged(old_entry, size, mtime_ns):
+    """Returns whether old_entry is still good for a file with this size and mtime"""
+    # Entries from manifests older than version 3 have no mtime, so for those we go on
+    # size alone
+    return (
+        old_entry is not None and size == old_entry.size and
+        old_entry.mtime_ns in (None, mtime_ns))
 
-            entry = entry_tuple(hash=item_hash, path=item_path, size=item_size)
-            manifest.append(entry)
-            progress(
-                num_files=len(manifest), hashed_files=hashed_files,
-                sized_files=sized_files, path=item_path)
+
+# How much of each end of a file goes into its quick fingerprint
+QUICK_FINGERPRINT_BYTES = 4096
 
 
 def get_hash(file_path):
-    import hashlib
-    blocksize = 65536
-    null_digest = "0" * 40
-    sha1 = hashlib.sha1()
+    import os
+    null_digest = bytes(20)
+    sha1 = sha1_new()
+
+    # Each hashing thread reads into its own buffer, reused from file to file, so there
+    # is no allocation per read and hashlib always sees the same memory
+    view = getattr(hash_buffers, 'view', None)
+    if view is None or len(view) != HASH_BLOCKSIZE:
+        view = hash_buffers.view = memoryview(bytearray(HASH_BLOCKSIZE))
+    status.path = file_path
+    read_counter = status.read_counter()
     try:
         read_bytes = 0
-        with open(file_path, 'rb') as f:
-            for data in iter(lambda: f.read(blocksize), b''):
-                sha1.update(data)
-                read_bytes += len(data)
-                hash_progress(path=file_path, read_bytes=read_bytes)
+        # Unbuffered, since we are already reading in big chunks
+        with open(file_path, 'rb', buffering=0) as f:
+            # Tell the OS we are going to read front to back, so it reads ahead more. It's
+            # only a hint, so if the file system won't take it, read the file anyway.
+            fd = None
+            if hasattr(os, 'posix_fadvise'):
+                fd = f.fileno()
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                except OSError:
+                    pass
+            while (n := f.readinto(view)):
+                read_bytes += n
+                read_counter[0] += n
+                # Once we know the file is more than a block long, keep the next few blocks
+                # requested, so the disk is fetching them while we hash this one. If the
+                # file system won't take the hint, stop asking for the rest of this file.
+                if fd is not None and n == len(view):
+                    try:
+                        os.posix_fadvise(
+                            fd, read_bytes, HASH_READAHEAD * len(view), os.POSIX_FADV_WILLNEED)
+                    except OSError:
+                        fd = None
+                sha1.update(view[:n])
         # print(f"{sha1.hexdigest()} {file_path}")
-        return sha1.hexdigest()
+        return sha1.digest()
     except Exception:
         # print(f"{null_digest} {file_path}")
         return null_digest
@@ -149,25 +536,35 @@ def get_hash(file_path):
 
 def find_dups(manifest_path, report_path, max_size, show_all):
     # get existing manifest
-    manifest = read_manifest(manifest_path)
+    status.start()
+    try:
+        manifest = read_manifest(manifest_path)
+    except BaseException:
+        status.stop()
+        raise
 
-    print(f"Finding duplicates")
+    status.print(f"Finding duplicates")
     import time
     start_time = time.time()
 
-    # turn it into a map of hashes to paths
-    hashes = dict()
-    for entry in manifest:
-        # hash, path = entry[0], entry[1]
-        if entry.hash not in hashes:
-            hashes[entry.hash] = []
-        hashes[entry.hash].append(entry.path)
-
-    # and create a map of hashes to sizes (each hash can only be one size)
+    # turn it into a map of hashes to paths, and a map of hashes to sizes (each hash
+    # can only be one size), in a single pass. Files that weren't hashed (see --dedup-fast)
+    # were left out because no other file could match them, so they count as unique.
+    from collections import defaultdict
+    hashes = defaultdict(list)
     sizes = dict()
+    unhashed = []
     for entry in manifest:
+        if entry.hash is None:
+            unhashed.append(entry)
+            continue
+        hashes[entry.hash].append(entry.path)
         sizes[entry.hash] = entry.size
 
+    # The status line is only for reading the manifest. The report can be a line per file,
+    # so it goes straight out, with no status line to erase and redraw around each one.
+    status.stop()
+
     # show hashes with multiple paths
     import sys
     report_out = sys.stdout
@@ -175,14 +572,15 @@ def find_dups(manifest_path, report_path, max_size, show_all):
         report_out = open(report_path, 'w', encoding='utf-8')
     num_dups = 0
     dup_files = 0
-    ignore_hashes = [
-        'da39a3ee5e6b4b0d3255bfef95601890afd80709',
-        '0000000000000000000000000000000000000000'
-    ]
+    ignore_hashes = frozenset([
+        bytes.fromhex('da39a3ee5e6b4b0d3255bfef95601890afd80709'),
+        bytes(20)
+    ])
 
     # sorted_hashes = sorted(list(hashes), key=lambda e: len(hashes[e]), reverse=True)
     extra = 0
-    sorted_hashes = sorted(list(sizes), key=lambda e: sizes[e], reverse=True)
+    # sizes.__getitem__ as the key keeps the whole sort in C, with no Python call per hash
+    sorted_hashes = sorted(sizes, key=sizes.__getitem__, reverse=True)
     for hash in sorted_hashes:
         paths = hashes[hash]
         if show_all is False and len(paths) < 2:
@@ -196,13 +594,22 @@ def find_dups(manifest_path, report_path, max_size, show_all):
         extra_GB = int(0.5 + extra / 1000000000)
         dups_text = f"{len(paths)} copies" if len(paths) >= 2 else ""
         print(
-            f"{hash}: size={sizes[hash]}, {dups_text} (total extra={extra_GB} GB)",
+            f"{hash.hex()}: size={sizes[hash]}, {dups_text} (total extra={extra_GB} GB)",
             file=report_out)
         for path in paths:
             print(f"    {path}", file=report_out)
             dup_files += 1
-        progress(num_files=len(manifest), hashed_files=len(hashes), sized_files=dup_files)
-    print(f"{len(hashes)} unique files out of {len(manifest)} total files", file=report_out)
+    if show_all:
+        # list the files that weren't hashed too, so every file is in the report
+        unhashed_paths = [
+            entry.path for entry in unhashed if entry.size is None or entry.size >= max_size]
+        if unhashed_paths:
+            print(f"unhashed: {len(unhashed_paths)} files", file=report_out)
+            for path in unhashed_paths:
+                print(f"    {path}", file=report_out)
+    print(
+        f"{len(hashes) + len(unhashed)} unique files out of {len(manifest)} total files",
+        file=report_out)
     print(
         f"{num_dups} duplicated hashes found, {dup_files} duplicated files found",
         file=report_out)
@@ -214,6 +621,26 @@ def find_dups(manifest_path, report_path, max_size, show_all):
     print(f"find_dups: elapsed time={elapsed_time:.3f}")
 
 
+# Version 2 and later manifests are binary. After the magic line, each entry is a
+# fixed-size record (raw 20-byte hash, size, length of path) followed by the utf-8 path.
+# Version 3 adds the modification time in nanoseconds after the size, and a flags byte
+# before the length of path; with MANIFEST_FLAG_NO_HASH set, the file wasn't hashed, the
+# hash bytes are all zero, and the entry's hash is None.
+MANIFEST_V2_MAGIC = b"MF2\n"
+MANIFEST_V2_RECORD = struct.Struct("<20sQH")
+MANIFEST_V3_MAGIC = b"MF3\n"
+MANIFEST_V3_RECORD = struct.Struct("<20sQqBH")
+MANIFEST_NO_SIZE = 0xFFFFFFFFFFFFFFFF
+MANIFEST_NO_MTIME = -(1 << 63)
+MANIFEST_FLAG_NO_HASH = 0x01
+
+# How to read each binary version: (magic, record, has mtime, has flags)
+MANIFEST_BINARY_FORMATS = {
+    2: (MANIFEST_V2_MAGIC, MANIFEST_V2_RECORD, False, False),
+    3: (MANIFEST_V3_MAGIC, MANIFEST_V3_RECORD, True, True),
+}
+
+
 def read_manifest(manifest_path):
     import os.path
     if not(manifest_path and os.path.exists(manifest_path)):
@@ -221,47 +648,104 @@ def read_manifest(manifest_path):
 
     import time
     start_time = time.time()
-    console_status("")
-    print(f"Reading manifest from {manifest_path}")
+    status.print(f"Reading manifest from {manifest_path}")
     manifest = []
-    with open(manifest_path, 'r', encoding='utf-8') as f:
-        # Get the first line, which is our version. It's either in utf-8 and
-        # is of the form "version <int>", or it's not and that means version 0
-        version_line = f.readline().rstrip()
-
-    if version_line == "version 1":
+    with open(manifest_path, 'rb') as f:
+        # Get the first line, which is our version. Versions 2 and 3 are binary and start
+        # with a magic line, version 1 is utf-8 text starting with "version <int>", and
+        # anything else means version 0
+        version_line = f.readline()
+
+    binary_versions = {
+        binary_format[0]: version for version, binary_format in MANIFEST_BINARY_FORMATS.items()}
+    if version_line in binary_versions:
+        read_manifest_binary(manifest, manifest_path, binary_versions[version_line])
+    elif version_line.rstrip() == b"version 1":
         read_manifest_v1(manifest, manifest_path)
     else:
         read_manifest_v0(manifest, manifest_path)
 
     elapsed_time = time.time() - start_time
-    print(f"read_manifest: {len(manifest)} entries, elapsed time={elapsed_time:.3f}")
+    status.print(f"read_manifest: {len(manifest)} entries, elapsed time={elapsed_time:.3f}")
     return manifest
 
 
 def read_manifest_v0(manifest, manifest_path, initial_line=None):
-    print("Assuming version 0 manifest")
+    import binascii
+    status.print("Assuming version 0 manifest")
+    with open(manifest_path, 'rb') as f:
+        body = f.read()
+
+    # Same approach as read_manifest_v1: one comprehension over the lines, with the
+    # line-by-line reader as a fallback to report errors. Each line is "<hex hash> <path>"
+    # in cp437.
+    unhex = binascii.unhexlify
+    # Duplicate files have equal hashes, and we'd like them to share one bytes object. It
+    # saves memory, and dict lookups in find_dups then match on identity before comparing
+    # bytes. sys.intern only takes str, so the readers do the same thing with a dict.
+    intern_hash = {}.setdefault
+    try:
+        manifest.extend([
+            entry_tuple(
+                hash=intern_hash(filehash, filehash), path=line[41:].decode('cp437').rstrip())
+            for line in body.splitlines() if line
+            for filehash in (unhex(line[:40]),)
+        ])
+    except Exception:
+        manifest.clear()
+        read_manifest_v0_lines(manifest, manifest_path)
+    return manifest
+
+
+def read_manifest_v0_lines(manifest, manifest_path):
     with open(manifest_path, 'r', encoding='cp437') as f:
         linenum = 1
         try:
             for line in f:
-                entry = entry_tuple(hash=line[:40], path=line[41:].rstrip())
+                entry = entry_tuple(hash=bytes.fromhex(line[:40]), path=line[41:].rstrip())
                 manifest.append(entry)
                 linenum += 1
         except Exception as e:
-            print(f"Error in line {linenum}: {line}")
+            status.print(f"Error in line {linenum}: {line}")
             raise e
     return manifest
 
 
 def read_manifest_v1(manifest, manifest_path):
-    print("Got version 1 manifest")
+    import binascii
+    status.print("Got version 1 manifest")
+    with open(manifest_path, 'rb') as f:
+        f.readline()  # skip past the already-read version line
+        body = f.read()
+
+    # Parse every line in one comprehension, so the per-line work stays in C as much as
+    # possible. Each line is "<hex hash> <size or None> <path>"
+    unhex = binascii.unhexlify
+    intern_hash = {}.setdefault  # share equal hashes, see read_manifest_v0
+    try:
+        manifest.extend([
+            entry_tuple(
+                hash=intern_hash(filehash, filehash), path=filepath.rstrip().decode('utf-8'),
+                size=None if filesize == b"None" else int(filesize))
+            for line in body.splitlines() if line
+            for filehash in (unhex(line[:40]),)
+            for filesize, _, filepath in (line[41:].partition(b" "),)
+        ])
+    except Exception:
+        # Something doesn't parse. Go back over the file a line at a time, so we can
+        # report which line is bad
+        manifest.clear()
+        read_manifest_v1_lines(manifest, manifest_path)
+    return manifest
+
+
+def read_manifest_v1_lines(manifest, manifest_path):
     with open(manifest_path, 'r', encoding='utf-8') as f:
         f.readline()  # skip past the already-read version line
         linenum = 2
         try:
             for line in f:
-                filehash = line[:40]
+                filehash = bytes.fromhex(line[:40])
                 sizepath = line[41:].rstrip()
                 i = sizepath.find(" ")
                 if i == -1:
@@ -274,87 +758,135 @@ def read_manifest_v1(manifest, manifest_path):
                 manifest.append(entry)
                 # print(f"Added hash={filehash} path={filepath} size={filesize}")
                 linenum += 1
-                progress(num_files=len(manifest))
+                status.num_files = len(manifest)
         except Exception as e:
-            print(f"Error in line {linenum}: {line}")
+            status.print(f"Error in line {linenum}: {line}")
             raise e
-        console_status("")
     return manifest
 
 
-def write_manifest(manifest, manifest_path):
-    # The current manifest version
-    manifest_version = 1
-
-    import time
-    start_time = time.time()
-    if manifest_path is None:
-        return
+def read_manifest_binary(manifest, manifest_path, version):
+    import mmap
+    status.print(f"Got version {version} manifest")
+    magic, record, has_mtime, has_flags = MANIFEST_BINARY_FORMATS[version]
+    unpack_record = record.unpack_from
+    record_size = record.size
+    intern_hash = {}.setdefault  # share equal hashes, see read_manifest_v0
+    with open(manifest_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = len(magic)
+        end = len(mm)
+        try:
+            while pos < end:
+                # hash and size come first and the path length last; any mtime and
+                # flags are in between
+                fields = unpack_record(mm, pos)
+                filehash, filesize, pathlen = fields[0], fields[1], fields[-1]
+                filemtime = fields[2] if has_mtime else MANIFEST_NO_MTIME
+                flags = fields[-2] if has_flags else 0
+                if flags & MANIFEST_FLAG_NO_HASH:
+                    filehash = None
+                else:
+                    filehash = intern_hash(filehash, filehash)
+                pos += record_size
+                if pos + pathlen > end:
+                    raise RuntimeError("Truncated path")
+                filepath = mm[pos:pos + pathlen].decode('utf-8', 'surrogateescape')
+                pos += pathlen
+                if filesize == MANIFEST_NO_SIZE:
+                    filesize = None
+                if filemtime == MANIFEST_NO_MTIME:
+                    filemtime = None
+                entry = entry_tuple(
+                    hash=filehash, path=filepath, size=filesize, mtime_ns=filemtime)
+                manifest.append(entry)
+                status.num_files = len(manifest)
+        except Exception as e:
+            status.print(f"Error in entry {len(manifest) + 1} at offset {pos}")
+            raise e
+    return manifest
 
-    console_status("")
-    print(f"Writing version {manifest_version} manifest to {manifest_path}")
-    with open(manifest_path, 'w', encoding='utf-8') as f:
-        print(f"version {manifest_version}", file=f)
-        for entry in manifest:
-            print(f"{entry.hash} {entry.size} {entry.path}", file=f)
 
-    elapsed_time = time.time() - start_time
-    print(f"write_manifest: elapsed time={elapsed_time:.3f}")
+class ManifestWriter(object):
+    """Writes a manifest an entry at a time
 
-
-last_progress_time = 0.0
-last_num_files = 0
-last_path = ""
-last_hashed_files = 0
-last_sized_files = 0
+    Entries go to a temporary file next to the manifest, which replaces the manifest in
+    finalize(), or is removed by discard() if the scan fails part way. That way the caller
+    never needs the whole manifest in memory, and a failed scan leaves the old manifest
+    alone. With no manifest path, entries are just counted.
+    """
+    # The current manifest version
+    version = 3
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.temp_path = None
+        self.f = None
+        self.batch = []
+        self.num_entries = 0
+        if manifest_path is not None:
+            self.temp_path = manifest_path + ".tmp"
+            self.f = open(self.temp_path, 'wb', buffering=1 << 20)
+            self.f.write(MANIFEST_V3_MAGIC)
+
+    def append(self, entry):
+        self.num_entries += 1
+        if self.f is None:
+            return
+        # surrogateescape round-trips file names that weren't valid utf-8 to begin with
+        path = entry.path.encode('utf-8', 'surrogateescape')
+        size = MANIFEST_NO_SIZE if entry.size is None else entry.size
+        mtime = MANIFEST_NO_MTIME if entry.mtime_ns is None else entry.mtime_ns
+        if entry.hash is None:
+            filehash, flags = bytes(20), MANIFEST_FLAG_NO_HASH
+        else:
+            filehash, flags = entry.hash, 0
+        self.batch.append(
+            MANIFEST_V3_RECORD.pack(filehash, size, mtime, flags, len(path)) + path)
+        # Encode entries a batch at a time and hand each batch to the file in one write
+        if len(self.batch) == 4096:
+            self.f.write(b"".join(self.batch))
+            self.batch.clear()
+
+    def finalize(self):
+        import os
+        if self.f is None:
+            return
+        self.f.write(b"".join(self.batch))
+        self.batch.clear()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        self.f = None
+        os.replace(self.temp_path, self.manifest_path)
+
+    def discard(self):
+        import os
+        if self.temp_path is None:
+            return
+        if self.f is not None:
+            try:
+                self.f.close()
+            except OSError:
+                pass  # the write that failed may fail again as close flushes
+            self.f = None
+        self.batch.clear()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
 
 
-def progress(num_files=None, hashed_files=None, sized_files=None, path=None):
-    """Shows progress every 0.1 seconds"""
-    import time
-    global last_progress_time
-    global last_num_files
-    global last_path
-    global last_hashed_files
-    global last_sized_files
-    if num_files is None:
-        num_files = last_num_files
-    if path is None:
-        path = last_path
-    if sized_files is None:
-        sized_files = last_sized_files
-    if hashed_files is None:
-        hashed_files = last_hashed_files
-    last_num_files = num_files
-    last_path = path
-    last_sized_files = sized_files
-    last_hashed_files = hashed_files
-
-    now = time.time()
-    if now - last_progress_time < 0.1:
-        return
-    elapsed_time = now - start_time
-    msg = f"T+{elapsed_time:.1f} Hashed={hashed_files} Sized={sized_files} Total={num_files} {path}"
-    console_status(msg)
-    last_progress_time = now
-
-
-def hash_progress(path=None, read_bytes=None):
-    import time
-    global last_progress_time
-    now = time.time()
-    if now - last_progress_time < 0.1:
-        return
-    elapsed_time = now - start_time
-    read_MB = int(0.5 + read_bytes / 1000000)
-    msg = f"T+{elapsed_time:.1f} Hashed={read_MB}MB {path}"
-    console_status(msg)
-    last_progress_time = now
+# Terminal width for console_status. Getting it is a syscall, so we keep it here and only
+# look again when the terminal tells us it was resized (SIGWINCH, installed by main), or
+# every second from the status thread where there is no SIGWINCH (Windows).
+term_columns = None
 
 
-def console_status(msg):
-    """Writes a full non-advancing line to the console"""
+def update_term_columns(*_):
+    """Re-reads the terminal width; also usable as a SIGWINCH handler"""
     import os
+    global term_columns
 
     # So, this has a problem. We can only get the size of a file descriptor connected to a
     # terminal. On the one hand, this is fine, because we are going to write to sys.stderr.
@@ -362,9 +894,14 @@ def console_status(msg):
     # in that case, we shouldn't try to write progress. There is a function that can tell if a
     # file descriptor is connected to a terminal, e.g. here sys.stderr.isatty().
     STDERR_FILENO = 2
-    term_size = os.get_terminal_size(STDERR_FILENO)  # the fd for sys.stderr
+    term_columns = os.get_terminal_size(STDERR_FILENO).columns  # the fd for sys.stderr
+
 
-    max_col = term_size.columns - 1
+def console_status(msg):
+    """Writes a full non-advancing line to the console"""
+    if term_columns is None:
+        update_term_columns()
+    max_col = term_columns - 1
 
     # Shorten long line so it won't cause scrolling when we output it
     if len(msg) > max_col: